@@ -4,30 +4,52 @@ extract.py — Main extraction script for vial label pipeline.
 Usage:
     python extract.py --config config.yaml
     python extract.py --config config.yaml --limit 30
+    python extract.py --config config.yaml --max-concurrency 128
 """
 
 import argparse
 import asyncio
-import base64
-import json
 import logging
 import os
 import re
 import sys
 from asyncio import Semaphore
+from collections.abc import Iterator
 from pathlib import Path
+from urllib.parse import urlparse
 
+import httpx
+import orjson
 import yaml
 from openai import AsyncOpenAI
 
-from preprocess import resize_image
-from parse_fields import parse_transcription
-from spreadsheet import write_spreadsheet
+from preprocess import compose_to_file, encode_file, resize_to_file
+from parse_fields import (
+    PARSE_FIELDS,
+    PARSE_FIELD_DESCRIPTIONS,
+    PARSE_RULES,
+    PARSE_SCHEMA,
+    empty_parse,
+    normalize_fields,
+    split_parsed,
+)
+from spreadsheet import SpreadsheetWriter
 
 EXTENSIONS = {".png", ".jpg", ".jpeg", ".tif", ".tiff"}
 
+LOCAL_HOSTS = {"localhost", "127.0.0.1", "::1"}
+
+DUNNLAB_RE = re.compile(r'DunnLab0*(\d+)', re.IGNORECASE)
+INTEGER_RE = re.compile(r'(\d+)')
+
+# Requests queue on the vLLM server at high concurrency, so allow a long read
+# timeout; connecting to localhost should be near-instant.
+REQUEST_TIMEOUT = httpx.Timeout(600.0, connect=5.0)
+
 EXTRACTION_PROMPT = """
 This image is a collage of cryovial photographs from the Dunn Lab.
+If more than one collage is provided (as separate images, or stacked one above another in one image), they all show the same vial; each collage has its own LEFT and RIGHT columns as described below. Combine information across them.
+The cryovials contain frozen siphonophore tissue (Dunn Lab, MBARI collections).
 The collage has two columns:
 - LEFT column: photos taken BEFORE a barcode label was added. These show handwritten text on the vial.
 - RIGHT column: photos taken AFTER a barcode label was added. These show a DataMatrix 2D barcode with a printed integer number below it.
@@ -35,165 +57,357 @@ The collage has two columns:
 Your tasks:
 1. Find the printed integer below the DataMatrix barcode in the RIGHT column images. This is the DataMatrix ID.
 2. Transcribe ALL handwritten text visible on the vial from the LEFT column images. Use the clearest view. Combine information across multiple left-column views if needed.
+3. Parse your transcription into the structured fields below.
 
 Return a JSON object with exactly these fields:
-{
+{{
   "datamatrix_integer": "<integer as string, or null if not found>",
   "transcribed_text": "<exact transcription of all handwritten text, preserving line breaks as \\n>",
   "transcription_confidence": <integer 0-10, where 10=perfectly legible, 0=completely illegible>,
-  "transcription_comments": "<note anything unusual: label obscured, unexpected layout, conflicting info across views, DataMatrix integer not matching filename, text partially cut off, etc. Empty string if nothing to note.>"
-}
-
+  "transcription_comments": "<note anything unusual: label obscured, unexpected layout, conflicting info across views, DataMatrix integer not matching filename, text partially cut off, etc. Empty string if nothing to note.>",
+{parse_field_descriptions}}}
+{parse_rules}
 Be conservative with confidence scores. A score of 8+ means you are highly certain of every character. Ambiguous letters or digits should lower the score. If you cannot read a word at all, transcribe it as [illegible].
 
 Return only the JSON object, no other text.
-"""
+""".format(
+    parse_field_descriptions=PARSE_FIELD_DESCRIPTIONS,
+    parse_rules=PARSE_RULES,
+)
+
+USER_PROMPT = "Extract the vial label data from the provided image(s)."
+
+EXTRACTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "datamatrix_integer": {"type": ["string", "null"]},
+        "transcribed_text": {"type": ["string", "null"]},
+        "transcription_confidence": {"type": "integer", "minimum": 0, "maximum": 10},
+        "transcription_comments": {"type": "string"},
+        **PARSE_SCHEMA,
+    },
+    "required": [
+        "datamatrix_integer",
+        "transcribed_text",
+        "transcription_confidence",
+        "transcription_comments",
+        *PARSE_FIELDS,
+    ],
+}
 
 
 def find_images(root_dir: str) -> list[Path]:
+    # os.scandir with an explicit stack avoids os.walk's extra stat calls and
+    # only builds Path objects for files that are images
     paths = []
-    for dirpath, _, filenames in os.walk(root_dir):
-        for fn in filenames:
-            p = Path(dirpath) / fn
-            if p.suffix.lower() in EXTENSIONS:
-                paths.append(p)
-    return sorted(paths)
+    stack = [root_dir]
+    while stack:
+        # Like os.walk, skip directories that are missing or unreadable
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    name = entry.name
+                    dot = name.rfind(".")
+                    if dot >= 0 and name[dot:].lower() in EXTENSIONS and entry.is_file():
+                        paths.append(entry.path)
+                except OSError:
+                    continue
+    return sorted(Path(p) for p in paths)
+
+
+def group_images(image_paths: list[Path]) -> list[list[Path]]:
+    """
+    Group image files that belong to the same vial, i.e. share the
+    DunnLabNNNNNN integer in their filename, so each vial is sent as one
+    request. Other files form their own group. Groups keep the order of
+    their first file.
+    """
+    groups = {}
+    for path in image_paths:
+        m = DUNNLAB_RE.search(path.stem)
+        key = m.group(1) if m else str(path)
+        groups.setdefault(key, []).append(path)
+    return list(groups.values())
 
 
 def extract_integer_from_filename(filename: str) -> str | None:
     stem = Path(filename).stem
     # Try DunnLabXXXXXX pattern first
-    m = re.search(r'DunnLab0*(\d+)', stem, re.IGNORECASE)
+    m = DUNNLAB_RE.search(stem)
     if m:
         return m.group(1)
     # Fallback: any integer in filename
-    m = re.search(r'(\d+)', stem)
+    m = INTEGER_RE.search(stem)
     if m:
         return m.group(1)
     return None
 
 
+def build_image_urls(
+    image_paths: list[Path],
+    max_image_size: int,
+    cache_dir: str,
+    max_images: int,
+    file_urls: bool,
+) -> list[str]:
+    # Runs in a worker thread: resizing and base64 encoding are CPU-bound
+    paths = [str(p) for p in image_paths]
+    if len(paths) > max_images:
+        files = [compose_to_file(paths, max_image_size, cache_dir)]
+    else:
+        files = [resize_to_file(p, max_image_size, cache_dir) for p in paths]
+    if file_urls:
+        return [f.as_uri() for f in files]
+    return [f"data:image/jpeg;base64,{encode_file(f)}" for f in files]
+
+
 async def extract_from_image(
     client: AsyncOpenAI,
-    image_path: Path,
+    cpu_sem: Semaphore,
+    image_paths: list[Path],
     model: str,
     max_image_size: int,
+    cache_dir: str,
+    max_images: int = 1,
+    file_urls: bool = False,
 ) -> dict:
-    img_bytes = resize_image(str(image_path), max_image_size)
-    b64 = base64.b64encode(img_bytes).decode()
+    # Decode/resize/encode in a worker thread so the event loop keeps serving
+    # HTTP; cpu_sem caps how many full-size images are decoded at once.
+    # With file_urls, vLLM reads the cached JPEG from disk, avoiding base64
+    # inflation of the request body. Groups larger than max_images are
+    # stacked into a single image.
+    async with cpu_sem:
+        image_urls = await asyncio.to_thread(
+            build_image_urls, image_paths, max_image_size, cache_dir, max_images, file_urls
+        )
 
     response = await client.chat.completions.create(
         model=model,
-        messages=[{
-            "role": "user",
-            "content": [
-                {
-                    "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{b64}"}
-                },
-                {
-                    "type": "text",
-                    "text": EXTRACTION_PROMPT
-                }
-            ]
-        }],
-        max_tokens=512,
+        # The static prompt goes first, in its own system message, so
+        # vLLM's prefix cache can reuse its KV across every request and
+        # only the image and the short user text are prefilled
+        messages=[
+            {"role": "system", "content": EXTRACTION_PROMPT},
+            {
+                "role": "user",
+                "content": [
+                    *(
+                        {
+                            "type": "image_url",
+                            "image_url": {"url": image_url}
+                        }
+                        for image_url in image_urls
+                    ),
+                    {
+                        "type": "text",
+                        "text": USER_PROMPT
+                    }
+                ]
+            },
+        ],
+        max_tokens=1024,
         temperature=0.1,
+        # Constrained decoding on the vLLM server guarantees schema-shaped JSON
+        response_format={
+            "type": "json_schema",
+            "json_schema": {"name": "vial_label", "schema": EXTRACTION_SCHEMA},
+        },
     )
 
-    raw = response.choices[0].message.content.strip()
-    # Strip markdown code fences if model adds them
-    raw = re.sub(r'^```(?:json)?\n?', '', raw)
-    raw = re.sub(r'\n?```$', '', raw)
-    return json.loads(raw)
+    raw = response.choices[0].message.content
+    return orjson.loads(raw)
 
 
-async def process_all(image_paths: list[Path], config: dict) -> list[dict]:
+def group_name(group: list[Path]) -> str:
+    return "; ".join(str(p) for p in group)
+
+
+def read_checkpoint(checkpoint_path: str) -> Iterator[dict]:
+    """
+    Yield rows from a previous run's JSONL checkpoint, one line at a time.
+    A truncated final line from a killed run is skipped.
+    """
+    if not os.path.exists(checkpoint_path):
+        return
+    with open(checkpoint_path, "rb") as f:
+        for line in f:
+            try:
+                yield orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+
+
+async def process_all(
+    image_groups: list[list[Path]],
+    config: dict,
+    max_concurrency: int,
+) -> int:
+    # Resume from the checkpoint: finished rows are carried into the output,
+    # and only vials that are new or whose extraction failed are re-run.
+    # Rows are keyed by image_file, which lists every file in the group; rows
+    # for vials outside this run (deleted, moved, regrouped or beyond --limit)
+    # are left in the checkpoint but not carried into the output. Later
+    # lines win, so a vial retried after a failure keeps its latest row. The
+    # checkpoint is read twice rather than held in memory: here to find each
+    # finished vial's last line, then below to stream those rows out.
+    checkpoint_path = os.path.splitext(config["output_file"])[0] + ".jsonl"
+    current = {group_name(g) for g in image_groups}
+    last_row = {}
+    for i, row in enumerate(read_checkpoint(checkpoint_path)):
+        name = row["image_file"]
+        if name not in current:
+            continue
+        if str(row.get("transcription_comments") or "").startswith("Extraction failed"):
+            last_row.pop(name, None)
+        else:
+            last_row[name] = i
+    image_groups = [g for g in image_groups if group_name(g) not in last_row]
+    if last_row:
+        print(f"Resuming: {len(last_row)} vials already processed, {len(image_groups)} remaining.")
+
+    # Size the connection pool to the semaphore so every in-flight request
+    # has a keep-alive connection instead of reconnecting
+    pool_size = max_concurrency + 16
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+        ),
+        timeout=REQUEST_TIMEOUT,
+    )
     client = AsyncOpenAI(
         base_url=config["vllm_base_url"],
         api_key="not-needed",
+        http_client=http_client,
+        max_retries=5,
     )
-    sem = Semaphore(config["batch_size"])
-    results = []
-    total = len(image_paths)
-
-    async def process_one(path: Path) -> dict:
-        async with sem:
-            filename_integer = extract_integer_from_filename(path.name)
-            try:
-                extracted = await extract_from_image(
-                    client, path, config["model"], config["max_image_size"]
-                )
-            except Exception as e:
-                logging.error(f"Extraction failed for {path}: {e}")
-                extracted = {
-                    "datamatrix_integer": None,
-                    "transcribed_text": None,
-                    "transcription_confidence": 0,
-                    "transcription_comments": f"Extraction failed: {e}",
-                }
-
-            # Parse transcribed text into structured fields
-            transcribed = extracted.get("transcribed_text")
-            if transcribed:
-                try:
-                    parsed = await parse_transcription(client, config["model"], transcribed)
-                except Exception as e:
-                    logging.error(f"Parsing failed for {path}: {e}")
-                    parsed = {
-                        "sample_number": None,
-                        "date": None,
-                        "sampling_event": None,
-                        "species": None,
-                        "tissue": None,
-                        "notes": "",
-                        "parse_confidence": 0,
-                        "parse_comments": f"Parsing failed: {e}",
-                    }
-            else:
-                parsed = {
-                    "sample_number": None,
-                    "date": None,
-                    "sampling_event": None,
-                    "species": None,
-                    "tissue": None,
-                    "notes": "",
-                    "parse_confidence": 0,
-                    "parse_comments": "No transcribed text to parse.",
-                }
-
-            dm_from_image = extracted.get("datamatrix_integer")
-            try:
-                datamatrix_match = (
-                    int(dm_from_image) == int(filename_integer)
-                    if dm_from_image is not None and filename_integer is not None
-                    else None
-                )
-            except (ValueError, TypeError):
-                datamatrix_match = False
-
-            return {
-                "image_file": str(path),
-                "filename_integer": filename_integer,
-                "datamatrix_match": datamatrix_match,
-                **extracted,
-                **parsed,
+    # sched_getaffinity respects the Slurm CPU allocation; cpu_count does not
+    if hasattr(os, "sched_getaffinity"):
+        n_cpus = len(os.sched_getaffinity(0))
+    else:
+        n_cpus = os.cpu_count() or 1
+    cpu_sem = Semaphore(n_cpus)
+    total = len(image_groups)
+
+    cache_dir = config.get("image_cache_dir", "output/image_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # file:// URLs only work when vLLM shares our filesystem
+    file_urls = config.get("image_transport", "data_url") == "file"
+    if file_urls and urlparse(config["vllm_base_url"]).hostname not in LOCAL_HOSTS:
+        logging.warning("vLLM server is not local; sending images as data URLs.")
+        file_urls = False
+
+    max_images = config.get("max_images_per_request", 1)
+
+    async def process_one(group: list[Path]) -> dict:
+        name = group_name(group)
+        filename_integer = extract_integer_from_filename(group[0].name)
+        try:
+            extracted = await extract_from_image(
+                client, cpu_sem, group, config["model"], config["max_image_size"],
+                cache_dir, max_images=max_images, file_urls=file_urls,
+            )
+        except Exception as e:
+            logging.error(f"Extraction failed for {name}: {e}")
+            extracted = {
+                "datamatrix_integer": None,
+                "transcribed_text": None,
+                "transcription_confidence": 0,
+                "transcription_comments": f"Extraction failed: {e}",
+                **empty_parse(f"Extraction failed: {e}"),
             }
 
-    tasks = [process_one(p) for p in image_paths]
-    for coro in asyncio.as_completed(tasks):
-        result = await coro
-        results.append(result)
-        logging.info(f"Processed {len(results)}/{total}: {result['image_file']}")
-        print(f"[{len(results)}/{total}] {result['image_file']}")
-
-    return results
+        extracted, parsed = split_parsed(extracted)
+        if not extracted.get("transcribed_text"):
+            parsed = empty_parse("No transcribed text to parse.")
+        normalize_fields(parsed)
+
+        dm_from_image = extracted.get("datamatrix_integer")
+        try:
+            datamatrix_match = (
+                int(dm_from_image) == int(filename_integer)
+                if dm_from_image is not None and filename_integer is not None
+                else None
+            )
+        except (ValueError, TypeError):
+            datamatrix_match = False
+
+        return {
+            "image_file": name,
+            "filename_integer": filename_integer,
+            "datamatrix_match": datamatrix_match,
+            **extracted,
+            **parsed,
+        }
+
+    # Rows are written to the spreadsheet as each vial completes rather than
+    # collected in memory, and appended to the checkpoint so a killed run can
+    # resume
+    writer = SpreadsheetWriter(config["output_file"])
+    for i, row in enumerate(read_checkpoint(checkpoint_path)):
+        if last_row.get(row["image_file"]) == i:
+            writer.append(row)
+    done = 0
+
+    # A fixed pool of max_concurrency workers pulls vials from a bounded
+    # queue, so at most max_concurrency requests are in flight and memory
+    # stays flat regardless of how many images there are
+    queue = asyncio.Queue(maxsize=max_concurrency * 2)
+
+    async def produce():
+        for group in image_groups:
+            await queue.put(group)
+        for _ in range(max_concurrency):
+            await queue.put(None)
+
+    async def work(checkpoint):
+        nonlocal done
+        while (group := await queue.get()) is not None:
+            result = await process_one(group)
+            checkpoint.write(orjson.dumps(result) + b"\n")
+            checkpoint.flush()
+            writer.append(result)
+            done += 1
+            logging.info(f"Processed {done}/{total}: {result['image_file']}")
+            print(f"[{done}/{total}] {result['image_file']}")
+
+    try:
+        with open(checkpoint_path, "a+b") as checkpoint:
+            # Start on a fresh line in case the last run was killed mid-write;
+            # read_checkpoint skips the partial line
+            if checkpoint.tell():
+                checkpoint.seek(-1, os.SEEK_END)
+                if checkpoint.read(1) != b"\n":
+                    checkpoint.write(b"\n")
+            await asyncio.gather(
+                produce(),
+                *(work(checkpoint) for _ in range(max_concurrency)),
+            )
+        writer.close()
+    finally:
+        await http_client.aclose()
+
+    return done
 
 
 def main():
     parser = argparse.ArgumentParser(description="Extract vial label data from collage images.")
     parser.add_argument("--config", default="config.yaml", help="Path to config YAML file.")
-    parser.add_argument("--limit", type=int, default=None, help="Process only first N images (for testing).")
+    parser.add_argument("--limit", type=int, default=None, help="Process only first N vials (for testing).")
+    parser.add_argument(
+        "--max-concurrency",
+        type=int,
+        default=None,
+        help="Maximum in-flight requests to vLLM (overrides batch_size in config).",
+    )
     args = parser.parse_args()
 
     with open(args.config) as f:
@@ -216,13 +430,20 @@ def main():
         print(f"No images found in {config['input_dir']}")
         sys.exit(1)
 
+    image_groups = group_images(image_paths)
     if args.limit:
-        image_paths = image_paths[: args.limit]
-
-    print(f"Found {len(image_paths)} images. Starting extraction...")
-    results = asyncio.run(process_all(image_paths, config))
-
-    write_spreadsheet(results, config["output_file"])
+        image_groups = image_groups[: args.limit]
+
+    print(f"Found {len(image_paths)} images of {len(image_groups)} vials. Starting extraction...")
+    max_concurrency = args.max_concurrency or config["batch_size"]
+    # uvloop (optional, Linux/macOS) cuts per-task scheduling overhead at
+    # hundreds of concurrent requests
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(process_all(image_groups, config, max_concurrency))
+    else:
+        uvloop.run(process_all(image_groups, config, max_concurrency))
 
 
 if __name__ == "__main__":
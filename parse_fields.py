@@ -1,83 +1,180 @@
 """
-parse_fields.py — Parse structured metadata from transcribed vial label text.
+parse_fields.py — Structured fields parsed from transcribed vial label text.
 
-Performs a second LLM call (text-only) to extract structured fields from raw
-transcribed text produced by extract.py.
+The parsing instructions below are embedded in the extraction prompt in
+extract.py, so transcription and parsing happen in a single LLM call per
+image. Species and tissue abbreviations are returned as written and
+corrected deterministically by normalize_fields().
 """
 
-import json
 import re
 
-from openai import AsyncOpenAI
+PARSE_FIELDS = [
+    "sample_number",
+    "date",
+    "sampling_event",
+    "species",
+    "tissue",
+    "notes",
+    "parse_confidence",
+    "parse_comments",
+]
 
-PARSE_PROMPT = """
-You are parsing a handwritten label from a cryovial containing frozen siphonophore tissue (Dunn Lab, MBARI collections).
-
-Transcribed label text:
-{transcribed_text}
-
-Extract the following fields. Return a JSON object:
-{{
+PARSE_FIELD_DESCRIPTIONS = """\
   "sample_number": "<e.g. 187 — integer only, no # symbol, or null>",
   "date": "<YYYYMMDD format, or null if not present>",
   "sampling_event": "<standardized event code, e.g. V401-SS2, D1041-D4, BW2, or null>",
-  "species": "<corrected full species name, e.g. Nanomia bijuga, Bargmannia elongata, or null if absent/illegible>",
-  "tissue": "<standardized tissue name, e.g. nectophore, gastrozooid, growth zone, whole, or null if not specified>",
+  "species": "<species name as written, e.g. Nanomia, B elongata, or null if absent/illegible>",
+  "tissue": "<tissue as written, e.g. necto 1, GZ, gastro, young male, or null if not specified>",
   "notes": "<anything on the label not fitting other fields, or empty string>",
   "parse_confidence": <integer 0-10>,
   "parse_comments": "<note ambiguities, corrected spellings, fields that could not be parsed, etc.>"
-}}
+"""
 
+PARSE_RULES = """
 Sampling event vehicle prefixes: V=Ventana, D=Doc Ricketts, T=Tiburon, W=Western Flyer, BW=blue water.
 Sampler codes: SS=suction sampler, D=detritus sampler, N=net, MC=midwater collection.
 
-Species corrections (apply these):
-- Nanomia / Nano / N bijuga / Nanomia SGZ / NANOMIA → Nanomia bijuga
-- B elongata / Bargmannia elong → Bargmannia elongata
-- Agalma / A elegans → Agalma elegans
-- Muggiaea / M atlantica → Muggiaea atlantica
-- Physo / Physophora → Physophora hydrostatica
-- Rosacea / R cymbiformis → Rosacea cymbiformis
-- Cordagalma → Cordagalma ordinatum
-- Apolemia → Apolemia sp.
-
-Tissue corrections:
-- necto / nectos / N followed by number → nectophore (record qualifier if present, e.g. "young nectophore", "mature nectophore", "nectophore 1")
-- young nectos / young necto → young nectophore
-- mature necto / mature nectos → mature nectophore
-- GZ / SGZ / siphosomal growth zone / Siphosomal GZ → siphosomal growth zone
-- gastro → gastrozooid
-- gonzo → gonozooid
-- pneu / pneum / pneumatophore → pneumatophore
-- palpon / palpons / young palpons → palpons
-- sipho (if tissue, not species) → whole siphonophore
-- stem → stem
-- young male / young female / mature male / mature female → record as-is in tissue field (denotes developmental stage/sex)
-
-Return only the JSON object.
+Return species and tissue abbreviations as written, in separate fields (e.g. "Nanomia SGZ" is species "Nanomia", tissue "SGZ"); normalization happens downstream.
 """
 
+# JSON schema properties for the parsed fields, merged into the extraction
+# schema so vLLM can constrain decoding to valid output.
+PARSE_SCHEMA = {
+    "sample_number": {"type": ["string", "null"]},
+    "date": {"type": ["string", "null"]},
+    "sampling_event": {"type": ["string", "null"]},
+    "species": {"type": ["string", "null"]},
+    "tissue": {"type": ["string", "null"]},
+    "notes": {"type": "string"},
+    "parse_confidence": {"type": "integer", "minimum": 0, "maximum": 10},
+    "parse_comments": {"type": "string"},
+}
+
+
+# Species and tissue corrections, keyed by normalize_key() of the text as
+# written. Extend these as new abbreviations are encountered.
+SPECIES_MAP = {
+    "nanomia": "Nanomia bijuga",
+    "nano": "Nanomia bijuga",
+    "n bijuga": "Nanomia bijuga",
+    "nanomia bijuga": "Nanomia bijuga",
+    "nanomia sgz": "Nanomia bijuga",
+    "b elongata": "Bargmannia elongata",
+    "bargmannia elong": "Bargmannia elongata",
+    "bargmannia elongata": "Bargmannia elongata",
+    "agalma": "Agalma elegans",
+    "a elegans": "Agalma elegans",
+    "agalma elegans": "Agalma elegans",
+    "muggiaea": "Muggiaea atlantica",
+    "m atlantica": "Muggiaea atlantica",
+    "muggiaea atlantica": "Muggiaea atlantica",
+    "physo": "Physophora hydrostatica",
+    "physophora": "Physophora hydrostatica",
+    "physophora hydrostatica": "Physophora hydrostatica",
+    "rosacea": "Rosacea cymbiformis",
+    "r cymbiformis": "Rosacea cymbiformis",
+    "rosacea cymbiformis": "Rosacea cymbiformis",
+    "cordagalma": "Cordagalma ordinatum",
+    "cordagalma ordinatum": "Cordagalma ordinatum",
+    "apolemia": "Apolemia sp.",
+    "apolemia sp": "Apolemia sp.",
+}
+
+TISSUE_MAP = {
+    "necto": "nectophore",
+    "nectos": "nectophore",
+    "neck": "nectophore",
+    "nectophore": "nectophore",
+    "nectophores": "nectophore",
+    "young necto": "young nectophore",
+    "young nectos": "young nectophore",
+    "mature necto": "mature nectophore",
+    "mature nectos": "mature nectophore",
+    "gz": "siphosomal growth zone",
+    "sgz": "siphosomal growth zone",
+    "siphosomal gz": "siphosomal growth zone",
+    "siphosomal growth zone": "siphosomal growth zone",
+    "gastro": "gastrozooid",
+    "gonzo": "gonozooid",
+    "pneu": "pneumatophore",
+    "pneum": "pneumatophore",
+    "pneumatophore": "pneumatophore",
+    "palpon": "palpons",
+    "young palpons": "palpons",
+    "sipho": "whole siphonophore",
+}
+
+# Numbered nectophores: "necto 1", "nectos 2", "N1", "N 3"
+NUMBERED_NECTOPHORE_RE = re.compile(r'^(?:n|necto|nectos|nectophore)\s*(\d+)$')
+
+
+def normalize_key(text: str) -> str:
+    """Lowercase, drop periods and collapse whitespace for map lookups."""
+    return " ".join(text.lower().replace(".", " ").split())
+
+
+def normalize_species(species: str | None) -> str | None:
+    if not species:
+        return species
+    return SPECIES_MAP.get(normalize_key(species), species)
+
+
+def normalize_tissue(tissue: str | None) -> str | None:
+    if not tissue:
+        return tissue
+    key = normalize_key(tissue)
+    if key in TISSUE_MAP:
+        return TISSUE_MAP[key]
+    m = NUMBERED_NECTOPHORE_RE.match(key)
+    if m:
+        return f"nectophore {m.group(1)}"
+    # Anything else (stem, young male, mature female, ...) is kept as written
+    return tissue
+
+
+def normalize_fields(parsed: dict) -> dict:
+    """
+    Apply species and tissue corrections to parsed fields in place, noting
+    each correction in parse_comments. Returns the same dict.
+    """
+    corrections = []
+    for name, normalize in (("species", normalize_species), ("tissue", normalize_tissue)):
+        written = parsed.get(name)
+        corrected = normalize(written)
+        if corrected != written:
+            parsed[name] = corrected
+            corrections.append(f"{name} '{written}' → '{corrected}'")
+    if corrections:
+        comments = parsed.get("parse_comments") or ""
+        parsed["parse_comments"] = "; ".join(filter(None, [comments, *corrections]))
+    return parsed
+
+
+def empty_parse(comment: str) -> dict:
+    """
+    Return the parsed fields with no values, for rows where parsing failed
+    or there was no transcribed text to parse.
+    """
+    return {
+        "sample_number": None,
+        "date": None,
+        "sampling_event": None,
+        "species": None,
+        "tissue": None,
+        "notes": "",
+        "parse_confidence": 0,
+        "parse_comments": comment,
+    }
+
 
-async def parse_transcription(
-    client: AsyncOpenAI,
-    model: str,
-    transcribed_text: str,
-) -> dict:
+def split_parsed(extracted: dict) -> tuple[dict, dict]:
     """
-    Call the LLM to parse structured fields from transcribed label text.
-    Returns a dict with sample_number, date, sampling_event, species, tissue,
-    notes, parse_confidence, parse_comments.
+    Split a combined extraction response into (extracted, parsed) dicts.
+    If any parsed field is missing, all parsed fields are reset to empty.
     """
-    prompt = PARSE_PROMPT.format(transcribed_text=transcribed_text)
-
-    response = await client.chat.completions.create(
-        model=model,
-        messages=[{"role": "user", "content": prompt}],
-        max_tokens=512,
-        temperature=0.1,
-    )
-
-    raw = response.choices[0].message.content.strip()
-    raw = re.sub(r'^```(?:json)?\n?', '', raw)
-    raw = re.sub(r'\n?```$', '', raw)
-    return json.loads(raw)
+    parsed = {name: extracted.pop(name) for name in PARSE_FIELDS if name in extracted}
+    if len(parsed) != len(PARSE_FIELDS):
+        missing = [name for name in PARSE_FIELDS if name not in parsed]
+        parsed = empty_parse(f"Parse fields missing from response: {', '.join(missing)}")
+    return extracted, parsed
@@ -1,5 +1,24 @@
 from PIL import Image
+import base64
+import hashlib
 import io
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+# Optional: encode with libjpeg-turbo directly via PyTurboJPEG, bypassing
+# PIL's save path. Falls back to PIL if the package or the shared library
+# is missing.
+try:
+    import numpy as np
+    from turbojpeg import TJPF_RGB, TurboJPEG
+    TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    TurboJPEG = None
+
+# TurboJPEG handles are not shared between threads
+_turbo = threading.local()
 
 
 def resize_image(image_path: str, max_size: int = 1500) -> bytes:
@@ -7,11 +26,107 @@ def resize_image(image_path: str, max_size: int = 1500) -> bytes:
     Resize image so longest edge <= max_size.
     Returns JPEG bytes. Preserves aspect ratio.
     """
-    img = Image.open(image_path).convert("RGB")
+    if _fits(image_path, max_size):
+        return Path(image_path).read_bytes()
+    return _encode_jpeg(_resize(image_path, max_size))
+
+
+def _encode_jpeg(img: Image.Image) -> bytes:
+    if TurboJPEG is None:
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=90)
+        return buf.getvalue()
+    if not hasattr(_turbo, "jpeg"):
+        _turbo.jpeg = TurboJPEG()
+    return _turbo.jpeg.encode(np.asarray(img), quality=90, pixel_format=TJPF_RGB)
+
+
+def _fits(image_path: str, max_size: int) -> bool:
+    # Image.open only reads the header, so this is cheap. RGB JPEGs that are
+    # already small enough can be sent as-is, skipping decode and a lossy
+    # re-encode; anything else (PNG, TIFF, CMYK, oversized) is re-encoded.
+    with Image.open(image_path) as img:
+        return img.format == "JPEG" and img.mode == "RGB" and max(img.size) <= max_size
+
+
+def _resize(image_path: str, max_size: int) -> Image.Image:
+    img = Image.open(image_path)
     w, h = img.size
+    size = None
     if max(w, h) > max_size:
         scale = max_size / max(w, h)
-        img = img.resize((int(w * scale), int(h * scale)), Image.LANCZOS)
-    buf = io.BytesIO()
-    img.save(buf, format="JPEG", quality=90)
-    return buf.getvalue()
+        size = (int(w * scale), int(h * scale))
+        # For JPEGs, libjpeg scales by 1/2, 1/4 or 1/8 during decode (never
+        # below size), which is much cheaper than decoding at full resolution
+        img.draft("RGB", size)
+    # Most inputs are already RGB; convert() would copy the whole image
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    if size:
+        # reducing_gap does a fast integer reduce first for non-JPEG formats
+        img = img.resize(size, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    return img
+
+
+def _cache_path(image_paths: list[str], max_size: int, cache_dir: str) -> Path:
+    # Keyed by each source's (path, mtime) plus max_size, so reruns reuse the
+    # file without decoding the sources again; edited photos get a new key
+    parts = []
+    for image_path in image_paths:
+        abspath = os.path.abspath(image_path)
+        parts.append(f"{abspath}\0{os.stat(abspath).st_mtime_ns}")
+    key_src = "\0".join(parts) + f"\0{max_size}"
+    key = hashlib.blake2b(key_src.encode(), digest_size=16).hexdigest()
+    return Path(cache_dir).resolve() / f"{key}.jpg"
+
+
+def _write_atomic(out_path: Path, data: bytes) -> None:
+    # Write to a unique temp file and rename, so an interrupted run or a
+    # concurrent writer never leaves a truncated JPEG under the final name
+    fd, tmp_path = tempfile.mkstemp(dir=out_path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def resize_to_file(image_path: str, max_size: int, cache_dir: str) -> Path:
+    """
+    Resize image to a JPEG in cache_dir and return its absolute path.
+    The file is keyed by (source path, mtime, max_size), so reruns reuse it
+    without decoding the source again; edited photos get a new key.
+    """
+    out_path = _cache_path([image_path], max_size, cache_dir)
+    if not out_path.exists():
+        _write_atomic(out_path, resize_image(image_path, max_size))
+    return out_path
+
+
+def compose_to_file(image_paths: list[str], max_size: int, cache_dir: str) -> Path:
+    """
+    Stack several collages of the same vial one above another into one JPEG,
+    for backends that accept one image per request. Each collage keeps its
+    own longest edge <= max_size (no further shrink), so the composite is
+    taller than max_size and each collage keeps its LEFT/RIGHT column layout.
+    Cached in cache_dir like resize_to_file.
+    """
+    out_path = _cache_path(image_paths, max_size, cache_dir)
+    if out_path.exists():
+        return out_path
+
+    tiles = [_resize(image_path, max_size) for image_path in image_paths]
+    collage = Image.new("RGB", (max(t.width for t in tiles), sum(t.height for t in tiles)), "white")
+    y = 0
+    for tile in tiles:
+        collage.paste(tile, (0, y))
+        y += tile.height
+    _write_atomic(out_path, _encode_jpeg(collage))
+    return out_path
+
+
+def encode_file(jpeg_path: Path) -> str:
+    """Return a JPEG file as base64, ready for a data URL."""
+    return base64.b64encode(jpeg_path.read_bytes()).decode()
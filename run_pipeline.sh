@@ -22,7 +22,9 @@ vllm serve Qwen/Qwen2.5-VL-72B-Instruct \
     --port 8000 \
     --quantization fp8 \
     --max-model-len 8192 \
-    --limit-mm-per-prompt '{"image": 1}' &
+    --enable-prefix-caching \
+    --limit-mm-per-prompt '{"image": 1}' \
+    --allowed-local-media-path "$PWD" &
 VLLM_PID=$!
 
 # Wait for server to be ready (poll up to 10 minutes)
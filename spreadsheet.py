@@ -1,9 +1,14 @@
 """
-spreadsheet.py — Write extraction results to a color-coded Excel file.
+spreadsheet.py — Stream extraction results to a color-coded Excel file and a CSV.
 """
 
+import csv
+import os
+
 import openpyxl
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import PatternFill, Font
+from openpyxl.utils import get_column_letter
 
 COLUMNS = [
     "image_file",
@@ -28,45 +33,80 @@ HEADER_FONT = Font(bold=True, color="FFFFFF")
 RED_FILL = PatternFill("solid", fgColor="FFCCCC")
 YELLOW_FILL = PatternFill("solid", fgColor="FFFACC")
 
+# Streamed sheets are written before the data is known, so free-text columns
+# get a fixed wide width instead of auto-width
+WIDE_COLUMNS = {
+    "image_file",
+    "transcribed_text",
+    "transcription_comments",
+    "notes",
+    "parse_comments",
+}
+
+
+def _row_fill(row: dict) -> PatternFill | None:
+    # Color-code rows by minimum confidence
+    t_conf = row.get("transcription_confidence") or 10
+    p_conf = row.get("parse_confidence") or 10
+    min_conf = min(t_conf, p_conf)
+    if min_conf <= 3:
+        return RED_FILL
+    elif min_conf <= 6:
+        return YELLOW_FILL
+    return None
+
 
-def write_spreadsheet(rows: list[dict], output_path: str) -> None:
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Vial Labels"
+class SpreadsheetWriter:
+    """
+    Stream rows to a write-only Excel workbook and a CSV file as they arrive,
+    instead of holding every row until the end. The CSV is written to
+    `<output>.csv.tmp` and flushed per row, so a killed run keeps its
+    results; it is renamed to `<output>.csv` on close().
+    """
 
-    # Header row
-    for col, name in enumerate(COLUMNS, 1):
-        cell = ws.cell(row=1, column=col, value=name)
-        cell.fill = HEADER_FILL
-        cell.font = HEADER_FONT
+    def __init__(self, output_path: str):
+        self.output_path = output_path
+        self.csv_path = os.path.splitext(output_path)[0] + ".csv"
+        self.rows = 0
 
-    for row_idx, row in enumerate(rows, 2):
+        self.wb = openpyxl.Workbook(write_only=True)
+        self.ws = self.wb.create_sheet("Vial Labels")
         for col, name in enumerate(COLUMNS, 1):
-            ws.cell(row=row_idx, column=col, value=row.get(name, ""))
-
-        # Color-code rows by minimum confidence
-        t_conf = row.get("transcription_confidence") or 10
-        p_conf = row.get("parse_confidence") or 10
-        min_conf = min(t_conf, p_conf)
-        if min_conf <= 3:
-            fill = RED_FILL
-        elif min_conf <= 6:
-            fill = YELLOW_FILL
-        else:
-            fill = None
-
-        if fill:
-            for col in range(1, len(COLUMNS) + 1):
-                ws.cell(row=row_idx, column=col).fill = fill
+            width = 60 if name in WIDE_COLUMNS else len(name) + 2
+            self.ws.column_dimensions[get_column_letter(col)].width = width
+
+        header = []
+        for name in COLUMNS:
+            cell = WriteOnlyCell(self.ws, value=name)
+            cell.fill = HEADER_FILL
+            cell.font = HEADER_FONT
+            header.append(cell)
+        self.ws.append(header)
+
+        self.csv_file = open(self.csv_path + ".tmp", "w", newline="")
+        self.csv_writer = csv.DictWriter(self.csv_file, fieldnames=COLUMNS, extrasaction="ignore")
+        self.csv_writer.writeheader()
+
+    def append(self, row: dict) -> None:
+        fill = _row_fill(row)
+        cells = []
+        for name in COLUMNS:
+            cell = WriteOnlyCell(self.ws, value=row.get(name, ""))
+            if fill:
+                cell.fill = fill
+            cells.append(cell)
 
         # Flag DataMatrix mismatches in that cell specifically
         if row.get("datamatrix_match") is False:
-            ws.cell(row=row_idx, column=COLUMNS.index("datamatrix_match") + 1).fill = RED_FILL
+            cells[COLUMNS.index("datamatrix_match")].fill = RED_FILL
 
-    # Auto-width columns
-    for col in ws.columns:
-        max_len = max((len(str(c.value or "")) for c in col), default=0)
-        ws.column_dimensions[col[0].column_letter].width = min(max_len + 2, 60)
+        self.ws.append(cells)
+        self.csv_writer.writerow(row)
+        self.csv_file.flush()
+        self.rows += 1
 
-    wb.save(output_path)
-    print(f"Saved {len(rows)} rows to {output_path}")
+    def close(self) -> None:
+        self.wb.save(self.output_path)
+        self.csv_file.close()
+        os.replace(self.csv_path + ".tmp", self.csv_path)
+        print(f"Saved {self.rows} rows to {self.output_path} and {self.csv_path}")